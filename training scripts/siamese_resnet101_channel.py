@@ -24,6 +24,7 @@ from itertools import combinations
 import random
 import cv2
 from sklearn.utils import shuffle
+import functools
 import os
 import pathlib
 import pickle
@@ -51,12 +52,34 @@ class ChannelAttention(layers.Layer):
         attention = tf.add(avg_pool, max_pool)
         return attention * inputs
 
+@functools.lru_cache(maxsize=4)
+def _GetFrozenBackbone(input_shape, weights):
+  """Builds (once) and caches a frozen ResNet101V2 backbone.
+
+  Every subnet factory used to instantiate its own ResNet101V2,
+  re-deserializing the ~170 MB weight file and rebuilding the graph per
+  model. The backbone is frozen everywhere, so ensembles can share a
+  single instance across subnets. Unlike the evaluation scripts, the
+  backbone is built under the default float32 policy: the attention/Dense
+  heads train on top of it, so activations keep full precision.
+
+  Args:
+    input_shape: Tuple, input shape of the backbone.
+    weights: Weights argument forwarded to ResNet101V2.
+
+  Returns:
+    backbone: Frozen ResNet101V2 Keras model (include_top=False).
+  """
+  backbone = ResNet101V2(
+      include_top=False, input_shape=input_shape, weights=weights)
+  for layer in backbone.layers:
+    layer.trainable = False
+  return backbone
+
+
 def Subnet(input_shape, weights):
   
-  backbone_model = ResNet101V2(input_shape=input_shape, include_top=False, weights=weights)
-
-  for layer in backbone_model.layers:
-      layer.trainable = False
+  backbone_model = _GetFrozenBackbone(input_shape, weights)
 
   conv2_x_out = backbone_model.get_layer('conv2_block3_out').output
   conv3_x_out = backbone_model.get_layer('conv3_block4_out').output
@@ -77,6 +100,9 @@ def Subnet(input_shape, weights):
 
   subnet_model = Model(backbone_model.input, concat_out)
 
+  # XLA-compile standalone inference (model.predict) so the chain of small
+  # expand/reshape/attention ops fuses into a few kernels.
+  subnet_model.compile(jit_compile=True)
 
   return subnet_model
 
@@ -130,6 +156,14 @@ def pair_generator(df, tqdm_desc=None, data_type='train'):
     pair_df = pd.DataFrame(pair_list)
     return pair_df
 
+class L2Distance(tf.keras.layers.Layer):
+    # Fused twin-distance layer: one traced op chain instead of a Python
+    # Lambda, with an epsilon so the sqrt gradient stays finite when the
+    # twin embeddings coincide.
+    def call(self, inputs):
+        output_1, output_2 = inputs
+        return tf.sqrt(tf.reduce_sum(tf.square(output_1 - output_2), axis=-1) + 1e-12)
+
 def Siamese(input_shape, weights):
 
   # Define the two input layers
@@ -139,13 +173,14 @@ def Siamese(input_shape, weights):
   # Define the Subnet model
   subnet = Subnet(input_shape, weights)
 
-  # Get the output of the Subnet model for the two input layers
-  output_1 = subnet(input_1)
-  output_2 = subnet(input_2)
+  # Run both twins through the subnet as one doubled batch: a single
+  # forward pass instead of two separate graph launches.
+  outputs = subnet(tf.concat([input_1, input_2], axis=0))
+  output_1, output_2 = tf.split(outputs, 2, axis=0)
 
   # Define the L1 distance layer
   #dist_layer = tf.keras.layers.Lambda(lambda x: K.sum(K.abs(x[0] - x[1]), axis=-1, keepdims=False))
-  dist_layer = tf.keras.layers.Lambda(lambda x: K.sqrt(K.sum(K.square(x[0] - x[1]), axis=-1, keepdims=False)))
+  dist_layer = L2Distance()
   distance = dist_layer([output_1, output_2])
 
   # Define the Siamese model
@@ -166,12 +201,13 @@ def Siamese(input_shape, weights):
 # subnet_model = siamese_model.layers[2]
 # subnet_model.summary()
 
+@tf.function
 def process_image(file_path):
     img = tf.io.read_file(file_path)
-    img = tf.image.decode_jpeg(img, channels=3)
+    img = tf.image.decode_jpeg(img, channels=3, dct_method='INTEGER_FAST')
+    img = tf.image.convert_image_dtype(img, tf.float32)  # Fused cast + scale to [0,1]
     img = tf.image.resize(img, [300, 300])
-    img /= 255.0  # Normalize pixel values to [0,1]
-    return img
+    return tf.cast(img, tf.float16)  # Model input layer upcasts to float32
 
 def load_image_pair_and_label(row):
     data_dir = './kaggle_datasets/train_dir/'
@@ -24,6 +24,7 @@ from itertools import combinations
 import random
 import cv2
 from sklearn.utils import shuffle
+import functools
 import os
 import pathlib
 import pickle
@@ -38,17 +39,42 @@ class SEBlock(layers.Layer):
         self.fc1 = layers.Dense(input_channels // ratio, activation='relu')
         self.fc2 = layers.Dense(input_channels, activation='sigmoid')
 
+    @tf.function(jit_compile=True)
     def call(self, inputs):
         x = self.pool(inputs)
         x = self.fc1(x)
         x = self.fc2(x)
-        x = tf.reshape(x, (-1, 1, 1, inputs.shape[-1]))
-        return layers.multiply([inputs, x])
+        # Broadcast the gate directly instead of reshape + multiply layer;
+        # with jit_compile XLA fuses the sigmoid and gating into one kernel.
+        return inputs * x[:, tf.newaxis, tf.newaxis, :]
+
+@functools.lru_cache(maxsize=4)
+def _GetFrozenBackbone(input_shape, weights):
+  """Builds (once) and caches a frozen ResNet101V2 backbone.
+
+  Every subnet factory used to instantiate its own ResNet101V2,
+  re-deserializing the ~170 MB weight file and rebuilding the graph per
+  model. The backbone is frozen everywhere, so ensembles can share a
+  single instance across subnets. Unlike the evaluation scripts, the
+  backbone is built under the default float32 policy: the attention/Dense
+  heads train on top of it, so activations keep full precision.
+
+  Args:
+    input_shape: Tuple, input shape of the backbone.
+    weights: Weights argument forwarded to ResNet101V2.
+
+  Returns:
+    backbone: Frozen ResNet101V2 Keras model (include_top=False).
+  """
+  backbone = ResNet101V2(
+      include_top=False, input_shape=input_shape, weights=weights)
+  for layer in backbone.layers:
+    layer.trainable = False
+  return backbone
+
 
 def resnet_se(input_shape=(300, 300, 3)):
-    resnet101v2_base = ResNet101V2(include_top=False, input_shape=input_shape, weights='imagenet')
-    for layer in resnet101v2_base.layers:
-        layer.trainable = False
+    resnet101v2_base = _GetFrozenBackbone(input_shape, 'imagenet')
     final_feature_map = resnet101v2_base.output
 
     input_channels = final_feature_map.shape[-1]
@@ -61,6 +87,14 @@ def resnet_se(input_shape=(300, 300, 3)):
 
     return model
 
+class L2Distance(tf.keras.layers.Layer):
+    # Fused twin-distance layer: one traced op chain instead of a Python
+    # Lambda, with an epsilon so the sqrt gradient stays finite when the
+    # twin embeddings coincide.
+    def call(self, inputs):
+        output_1, output_2 = inputs
+        return tf.sqrt(tf.reduce_sum(tf.square(output_1 - output_2), axis=-1) + 1e-12)
+
 def Siamese(input_shape):
 
   # Define the two input layers
@@ -71,12 +105,13 @@ def Siamese(input_shape):
   # subnet = Subnet(input_shape, weights)
   subnet = resnet_se(input_shape)
 
-  # Get the output of the Subnet model for the two input layers
-  output_1 = subnet(input_1)
-  output_2 = subnet(input_2)
+  # Run both twins through the subnet as one doubled batch: a single
+  # forward pass instead of two separate graph launches.
+  outputs = subnet(tf.concat([input_1, input_2], axis=0))
+  output_1, output_2 = tf.split(outputs, 2, axis=0)
 
   # Define the L2 distance layer
-  dist_layer = tf.keras.layers.Lambda(lambda x: K.sqrt(K.sum(K.square(x[0] - x[1]), axis=-1, keepdims=False)))
+  dist_layer = L2Distance()
   distance = dist_layer([output_1, output_2])
 
   # Define the Siamese model
@@ -148,12 +183,13 @@ def pair_generator(df, tqdm_desc=None, data_type='train'):
 # subnet_model = siamese_model.layers[2]
 # subnet_model.summary()
 
+@tf.function
 def process_image(file_path):
     img = tf.io.read_file(file_path)
-    img = tf.image.decode_jpeg(img, channels=3)
+    img = tf.image.decode_jpeg(img, channels=3, dct_method='INTEGER_FAST')
+    img = tf.image.convert_image_dtype(img, tf.float32)  # Fused cast + scale to [0,1]
     img = tf.image.resize(img, [300, 300])
-    img /= 255.0  # Normalize pixel values to [0,1]
-    return img
+    return tf.cast(img, tf.float16)  # Model input layer upcasts to float32
 
 def load_image_pair_and_label(row):
     data_dir = './kaggle_datasets/train_dir/'